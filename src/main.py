@@ -3,11 +3,12 @@
 TW50 自動化（V3 大改版，穩定版）
 ------------------------------------------------
 ✓ 統一用 google-auth + gspread（不依賴 oauth2client）
-✓ 所有技術指標都先把資料壓成一維 Series（避免 (n,1)）
+✓ 技術指標直接以收盤價 ndarray 算最後一列純量（numba 加速，不產生整段 Series）
 ✓ 寫表前將 Timestamp / numpy 全部轉 Python 原生型別（避免 JSON 錯誤）
 ✓ 只用「純量」做判斷（不對整個 Series 做 if，避免 ambiguous）
 ✓ 找不到資料/API 失敗：跳過並寫入 Logs，不中斷整批
-✓ 分頁不存在會自動建立，且會覆蓋寫入（全量表頭+資料）
+✓ 分頁不存在會自動建立；內容有變才覆蓋寫入（全量表頭+資料）
+  內容與上次寫入相同（假日、無新K棒）的分頁只更新 A1 的 Last Update 時戳，資料列（含資料時戳欄）維持上次寫入
 ✓ 可用 config.json 自訂標的（沒有就用內建 TW50 清單）
 ------------------------------------------------
 需要的 Secrets：
@@ -16,16 +17,26 @@ TW50 自動化（V3 大改版，穩定版）
 （FINMIND_TOKEN 保留未來擴充，不必填）
 """
 
-import os, io, json, math, time
+import os, io, json, math, time, hashlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timezone, timedelta
-from typing import List, Tuple, Dict, Any
+from typing import List, Tuple, Dict, Any, TYPE_CHECKING
 
 import numpy as np
 import pandas as pd
 import yfinance as yf
 
-import gspread
-from google.oauth2.service_account import Credentials
+if TYPE_CHECKING:  # gspread / google-auth 延到真的要連 Sheets 才載入（缺 Secrets 時不必付匯入成本）
+    import gspread
+
+try:
+    from numba import njit, prange
+except ImportError:  # 沒裝 numba：退回純 Python（結果相同，只是較慢）
+    def njit(*args, **kwargs):
+        if len(args) == 1 and callable(args[0]) and not kwargs:
+            return args[0]
+        return lambda f: f
+    prange = range
 
 # ========= 參數 =========
 TZ = timezone(timedelta(hours=8))  # Asia/Taipei
@@ -37,6 +48,30 @@ TAB_HOT20     = "Hot20_nonfin"
 TAB_TOP5H20   = "Top5_hot20"
 TAB_LOGS      = "Logs"
 
+# 輸出欄位（固定順序）：analyze 建前 16 欄（至 BB_Lower）、decide 補後 5 欄，aggregate 最後依此 reindex
+COLUMNS = (
+    "資料時戳(Asia/Taipei)","Date","Ticker","公司名稱","Open","High","Low","Close","Volume",
+    "RSI14","SMA20","SMA50","SMA200","BB_Mid","BB_Upper","BB_Lower",
+    "多空趨勢","操作建議","建議進場","建議出場","信心分數"
+)
+
+BATCH_SIZE   = 20  # Yahoo 單次請求約可帶 20 檔
+def _env_workers(default: int = 8) -> int:
+    """TW50_MAX_WORKERS：空值/非數字用預設，0 或負數夾到 1（避免 import 或開執行緒池時直接炸掉）"""
+    try:
+        return max(1, int(os.environ.get("TW50_MAX_WORKERS", "").strip() or default))
+    except ValueError:
+        print(f"[WARN] TW50_MAX_WORKERS 不是整數，改用預設 {default}")
+        return default
+
+MAX_WORKERS  = _env_workers()  # 名稱查詢並行數；被 Yahoo 限流時調低
+META_KEY     = "tw50_content_hash"  # 分頁內容雜湊存在該分頁的 developer metadata（隱藏，不佔儲存格）
+CACHE_DIR    = ".cache"  # 本機快取（公司名稱、日K）
+HIST_DAYS    = 400       # 日K 取近 400 天（SMA200 需約 200 個交易日）
+DELTA_PERIOD = "1mo"     # 快取過期時只補抓這段接在尾端
+MARKET_CLOSE = (14, 0)    # 台股 13:30 收盤，留半小時給 Yahoo 收齊；此後寫的日K快取才算含完整當日K
+NAME_TTL_H   = 24 * 7    # 公司名稱極少變動，一週重查一次
+
 # 內建 TW50 簡表（可被 config.json 覆蓋）
 DEFAULT_ALL = [
     "2330.TW","2317.TW","2454.TW","6505.TW","2308.TW","2303.TW","2891.TW","2881.TW","2882.TW",
@@ -52,41 +87,52 @@ DEFAULT_FIN = [t for t in DEFAULT_ALL if t.startswith(("288", "289"))]
 def now_str():
     return datetime.now(TZ).strftime("%Y-%m-%d %H:%M:%S")
 
-def squeeze_1d(x) -> pd.Series:
-    """把可能是 (n,1) 的資料強制壓成一維 Series"""
-    if isinstance(x, pd.Series):
-        return x.squeeze()
-    if isinstance(x, pd.DataFrame):
-        s = x.iloc[:, 0] if x.shape[1] > 0 else pd.Series([], dtype="float64")
-        return s.squeeze()
-    return pd.Series(np.asarray(x).squeeze())
+def last_close_time() -> float:
+    """最近一次（已過的）收盤時點 epoch 秒；週末往前推到週五，國定假日不另判（頂多多補抓一次）"""
+    now = datetime.now(TZ)
+    t = now.replace(hour=MARKET_CLOSE[0], minute=MARKET_CLOSE[1], second=0, microsecond=0)
+    if t > now:
+        t -= timedelta(days=1)
+    while t.weekday() >= 5:
+        t -= timedelta(days=1)
+    return t.timestamp()
 
 def to_native(v):
     """轉成 Google Sheets 可吃的型別"""
     if v is None or (isinstance(v, float) and math.isnan(v)):
         return ""
-    if isinstance(v, (pd.Timestamp, np.datetime64, datetime)):
-        return pd.to_datetime(v).strftime("%Y-%m-%d")
+    if isinstance(v, datetime):  # 含 pd.Timestamp
+        return v.strftime("%Y-%m-%d")
+    if isinstance(v, np.datetime64):
+        return pd.Timestamp(v).strftime("%Y-%m-%d")
     if isinstance(v, np.generic):
         return v.item()
     return v
 
+def _col_values(s: pd.Series) -> List:
+    """單欄轉成 Sheets 可吃的 list；依 dtype 決定一次轉法，免逐格判型別"""
+    if pd.api.types.is_datetime64_any_dtype(s):  # 含帶時區；NaT 轉出為 NaN，交給 to_native
+        return [to_native(v) for v in s.dt.strftime("%Y-%m-%d").tolist()]
+    if pd.api.types.is_float_dtype(s):
+        return ["" if math.isnan(v) else v for v in s.tolist()]
+    if pd.api.types.is_integer_dtype(s) or pd.api.types.is_bool_dtype(s):
+        return s.tolist()  # 已是 Python int/bool
+    return [to_native(v) for v in s.tolist()]
+
 def df_to_values(df: pd.DataFrame) -> List[List]:
     if df is None or df.empty:
         return []
-    out = df.copy()
-    # 轉日期欄位
-    for c in out.columns:
-        if np.issubdtype(out[c].dtype, np.datetime64):
-            out[c] = pd.to_datetime(out[c]).dt.strftime("%Y-%m-%d")
-    out = out.applymap(to_native)
-    return [out.columns.tolist()] + out.values.tolist()
+    # 逐欄轉換再 zip 成列：不 copy 整張表，也不經 .values / astype(str)（會整表升成 object 陣列）
+    cols = [_col_values(df[c]) for c in df.columns]
+    return [df.columns.tolist()] + [list(row) for row in zip(*cols)]
 
 # ========= Google Sheets =========
-def gs_client() -> gspread.Client:
+def gs_client() -> "gspread.Client":
     raw = os.environ.get("GCP_SERVICE_ACCOUNT_JSON", "").strip()
     if not raw:
         raise RuntimeError("缺少 GCP_SERVICE_ACCOUNT_JSON")
+    import gspread
+    from google.oauth2.service_account import Credentials
     info = json.loads(raw)
     scopes = ["https://www.googleapis.com/auth/spreadsheets",
               "https://www.googleapis.com/auth/drive"]
@@ -99,23 +145,131 @@ def open_sheet():
         raise RuntimeError("缺少 SHEET_ID")
     return gs_client().open_by_key(sid)
 
-def ensure_ws(sh: gspread.Spreadsheet, title: str, rows=1000, cols=40):
+def content_hash(values: List[List]) -> str:
+    """分頁內容雜湊；資料時戳欄每次執行都不同，不算內容"""
+    if values and values[0][:1] == [COLUMNS[0]]:
+        values = [r[1:] for r in values]
+    raw = json.dumps(values, ensure_ascii=False, default=str).encode("utf-8")
+    return hashlib.blake2b(raw, digest_size=16).hexdigest()
+
+def sheet_meta(sheet: Dict[str, Any]) -> Dict[str, Any]:
+    """分頁 metadata 裡本程式存的內容雜湊那筆（沒有回空 dict）"""
+    return next((m for m in sheet.get("developerMetadata", ()) if m.get("metadataKey") == META_KEY), {})
+
+def meta_request(sheet: Dict[str, Any], h: str) -> Dict[str, Any]:
+    """更新（沒有就建立）分頁的內容雜湊 developer metadata"""
+    mid = sheet_meta(sheet).get("metadataId")
+    if mid is not None:
+        return {"updateDeveloperMetadata": {
+            "dataFilters": [{"developerMetadataLookup": {"metadataId": mid}}],
+            "developerMetadata": {"metadataValue": h}, "fields": "metadataValue"}}
+    return {"createDeveloperMetadata": {"developerMetadata": {
+        "metadataKey": META_KEY, "metadataValue": h, "visibility": "DOCUMENT",
+        "location": {"sheetId": sheet["properties"]["sheetId"]}}}}
+
+def write_tabs(sh: "gspread.Spreadsheet", tabs: List[Tuple[str, pd.DataFrame, bool]]):
+    """多個分頁一次寫入：(分頁名, 表, 是否加時戳)
+    取分頁清單（連同各分頁的內容雜湊 metadata）、清空、寫值各一次 API，不逐頁 clear + update；
+    缺分頁多一次建立、有分頁內容變動多一次更新雜湊。
+    內容與上次寫入相同（假日、無新K棒）的分頁不清空、不重寫資料，只更新 A1 時戳"""
+    from gspread.utils import absolute_range_name
+    sheets = {s["properties"]["title"]: s for s in sh.fetch_sheet_metadata()["sheets"]}
+    stamp_row = [f"Last Update (Asia/Taipei): {now_str()}"]
+    changed = {}; clear = []; data = []; add = []
+    for title, df, stamp in tabs:
+        values = df_to_values(df)
+        h = content_hash(values)
+        if title in sheets and sheet_meta(sheets[title]).get("metadataValue") == h:
+            if stamp:
+                data.append({"range": absolute_range_name(title, "A1"), "values": [stamp_row]})
+            continue
+        changed[title] = h
+        if title not in sheets:
+            grid = {"rowCount": max(1000, len(df) + 10), "columnCount": max(40, len(df.columns) + 2)}
+            add.append({"addSheet": {"properties": {"title": title, "gridProperties": grid}}})
+        clear.append(absolute_range_name(title))
+        if stamp:
+            values = [stamp_row, []] + values  # A1 時戳、空一列、A3 起資料
+        if values:
+            data.append({"range": absolute_range_name(title, "A1"), "values": values})
+    if add:  # 缺的分頁一次 batchUpdate 建好，不逐頁 add_worksheet
+        for r in sh.batch_update({"requests": add})["replies"]:
+            props = r["addSheet"]["properties"]
+            sheets[props["title"]] = {"properties": props}
+    if clear:
+        sh.values_batch_clear(body={"ranges": clear})
+    if data:
+        sh.values_batch_update(body={"valueInputOption": "RAW", "data": data})
+    if changed:  # 寫成功後才記雜湊，寫到一半失敗下次會整頁重寫
+        sh.batch_update({"requests": [meta_request(sheets[t], h) for t, h in changed.items()]})
+
+# ========= 本機快取 =========
+def name_cache_path() -> str:
+    return os.path.join(CACHE_DIR, "names.json")
+
+def _read_name_entries() -> Dict[str, List]:
+    """names.json 原始內容 {ticker: [名稱, 查詢時間 epoch]}；只留 NAME_TTL_H 內的（舊格式/讀取失敗視為空）"""
+    try:
+        with io.open(name_cache_path(), "r", encoding="utf-8") as f:
+            raw = json.load(f)
+    except Exception:
+        return {}
+    cutoff = time.time() - NAME_TTL_H * 3600
+    return {t: v for t, v in raw.items() if isinstance(v, list) and len(v) == 2 and v[1] >= cutoff}
+
+def load_name_cache() -> Dict[str, str]:
+    """公司名稱快取（逐筆記查詢時間；超過 NAME_TTL_H 的那筆作廢重查，補寫新名稱不會延長舊的）"""
+    return {t: v[0] for t, v in _read_name_entries().items()}
+
+def save_name_cache(fresh: Dict[str, str]):
+    """把本次新查到的名稱併進快取（記本次時間）；既有未過期的保留原查詢時間"""
+    path = name_cache_path()
+    try:
+        now = time.time()
+        entries = {**_read_name_entries(), **{t: [name, now] for t, name in fresh.items()}}
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        tmp = path + ".tmp"
+        with io.open(tmp, "w", encoding="utf-8") as f:
+            json.dump(entries, f, ensure_ascii=False)
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[WARN] 名稱快取寫入失敗：{e}")
+
+def hist_cache_path(ticker: str) -> str:
+    return os.path.join(CACHE_DIR, "hist", f"{ticker}.parquet")
+
+def load_hist_cache(ticker: str) -> Tuple[Any, bool]:
+    """回： (日K快取或 None, 是否新鮮)；不存在/讀取失敗回 (None, False)
+    新鮮 = 寫於最近一次收盤之後；盤中寫的快取最後一根是未收K，一律當過期走補抓（補抓會換掉最後一根）"""
+    path = hist_cache_path(ticker)
+    try:
+        fresh = os.path.getmtime(path) >= last_close_time()
+        hist = pd.read_parquet(path)
+        return (hist, fresh) if not hist.empty else (None, False)
+    except Exception:
+        return None, False
+
+def merge_delta(old: pd.DataFrame, new: pd.DataFrame):
+    """把近期日K接到舊快取尾端；重疊段（不含舊的最後一根，可能是盤中未收）收盤價須一致，
+    對不上代表除權息後還原價整段改寫，回 None 讓呼叫端整段重抓"""
+    overlap = old.index.intersection(new.index)[:-1]
+    if len(overlap) == 0:
+        return None
+    if not np.allclose(old.loc[overlap, "Close"].to_numpy(dtype=np.float64),
+                       new.loc[overlap, "Close"].to_numpy(dtype=np.float64), rtol=1e-6):
+        return None
+    merged = pd.concat([old[old.index < new.index[0]], new])
+    return merged[merged.index > merged.index[-1] - pd.Timedelta(days=HIST_DAYS)]
+
+def save_hist_cache(ticker: str, hist: pd.DataFrame):
+    path = hist_cache_path(ticker)
     try:
-        return sh.worksheet(title)
-    except gspread.WorksheetNotFound:
-        return sh.add_worksheet(title=title, rows=rows, cols=cols)
-
-def write_df(sh, title: str, df: pd.DataFrame, stamp=True):
-    ws = ensure_ws(sh, title, rows=max(1000, len(df) + 10), cols=max(40, len(df.columns) + 2))
-    ws.clear()
-    values = df_to_values(df)
-    if stamp:
-        ws.update("A1", [[f"Last Update (Asia/Taipei): {now_str()}"]], value_input_option="RAW")
-        start = "A3"
-    else:
-        start = "A1"
-    if values:
-        ws.update(start, values, value_input_option="RAW")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        tmp = path + ".tmp"
+        hist.to_parquet(tmp, compression="zstd")  # 比預設 snappy 小，actions/cache 上傳下載較快
+        os.replace(tmp, path)
+    except Exception as e:
+        print(f"[WARN] 日K快取寫入失敗 {ticker}：{e}")
 
 # ========= 設定（config.json 可選） =========
 def load_config():
@@ -127,143 +281,237 @@ def load_config():
         pass
     all_list = cfg.get("all", DEFAULT_ALL)
     fin_list = cfg.get("fin", DEFAULT_FIN)
-    nonfin_list = [t for t in all_list if t not in set(fin_list)]
+    fin_set = set(fin_list)  # 只建一次，避免每個元素都重建 set
+    nonfin_list = [t for t in all_list if t not in fin_set]
     return all_list, fin_list, nonfin_list
 
 # ========= 指標 =========
-def rsi_ewm(close: pd.Series, period=14) -> pd.Series:
-    c = squeeze_1d(close).astype(float)
-    delta = c.diff()
-    gain = delta.clip(lower=0.0)
-    loss = -delta.clip(upper=0.0)
-    up = gain.ewm(alpha=1/period, adjust=False).mean()
-    dn = loss.ewm(alpha=1/period, adjust=False).mean()
-    rs = up / (dn.replace(0, np.nan))
-    rsi = 100 - (100 / (1 + rs))
-    return rsi
-
-def add_indicators(df: pd.DataFrame) -> pd.DataFrame:
-    out = df.copy()
-    close = squeeze_1d(out["Close"]).astype(float)
-    out["SMA20"]  = close.rolling(20, min_periods=1).mean()
-    out["SMA50"]  = close.rolling(50, min_periods=1).mean()
-    out["SMA200"] = close.rolling(200, min_periods=1).mean()
-    out["RSI14"]  = rsi_ewm(close, 14)
-    mid = out["SMA20"]
-    std = close.rolling(20, min_periods=1).std(ddof=0)
-    out["BB_Mid"]   = mid
-    out["BB_Upper"] = mid + 2 * std
-    out["BB_Lower"] = mid - 2 * std
+@njit(cache=True)
+def wilder_rsi_last(close: np.ndarray, period: int) -> float:
+    """Wilder RSI 的最後一個值（等同 ewm(alpha=1/period, adjust=False)）；不足 2 筆或跌幅均值為 0 回 NaN"""
+    n = close.shape[0]
+    alpha = 1.0 / period; decay = 1.0 - alpha
+    up = np.nan; dn = np.nan
+    if n >= 2:
+        d = close[1] - close[0]
+        up = d if d > 0.0 else 0.0
+        dn = -d if d < 0.0 else 0.0
+    for i in range(2, n):
+        d = close[i] - close[i - 1]
+        g = d if d > 0.0 else 0.0
+        l = -d if d < 0.0 else 0.0
+        up = decay * up + alpha * g
+        dn = decay * dn + alpha * l
+    if dn == dn and dn != 0.0:
+        return 100.0 - 100.0 / (1.0 + up / dn)
+    return np.nan
+
+@njit(cache=True)
+def last_indicators(close: np.ndarray) -> Tuple[float, float, float, float, float, float, float]:
+    """只回最後一列：(SMA20, SMA50, SMA200, RSI14, BB_Mid, BB_Upper, BB_Lower)
+    口徑：均線/布林不足窗長時用現有筆數（min_periods=1）、std ddof=0；
+    RSI 為 Wilder 平滑（等同 ewm(alpha=1/14, adjust=False)），跌幅均值為 0 時回 NaN"""
+    n = close.shape[0]
+    if n == 0:
+        return np.nan, np.nan, np.nan, np.nan, np.nan, np.nan, np.nan
+
+    # 均線只需尾端 200 根：20 → 50 → 200 分段累加，窗長寫死為字面常數，迴圈內無分支
+    w20 = min(n, 20); w50 = min(n, 50); w200 = min(n, 200)
+    # 最後 20 根：一趟同時累加總和與 Welford M2（布林 std 不必再掃第二次，也不用平方和相減）
+    s20 = 0.0; mean20 = 0.0; m2 = 0.0
+    for k in range(w20):
+        x = close[n - w20 + k]
+        s20 += x
+        d = x - mean20
+        mean20 += d / (k + 1)
+        m2 += d * (x - mean20)
+    s50 = s20
+    for i in range(n - w50, n - w20):
+        s50 += close[i]
+    s200 = s50
+    for i in range(n - w200, n - w50):
+        s200 += close[i]
+    sma20 = s20 / w20; sma50 = s50 / w50; sma200 = s200 / w200
+
+    std = math.sqrt(m2 / w20)  # 布林（ddof=0）
+
+    # RSI：Wilder 遞迴記憶無限長，截尾會偏離原口徑，仍走完整段（純量迴圈，成本低）
+    rsi = wilder_rsi_last(close, 14)
+
+    return sma20, sma50, sma200, rsi, sma20, sma20 + 2 * std, sma20 - 2 * std
+
+@njit(parallel=True, cache=True)
+def batch_indicators(closes: np.ndarray, lengths: np.ndarray) -> np.ndarray:
+    """多檔一起算：closes 為 (N, T) 靠左對齊、長度不足補 NaN，lengths[i] 為第 i 檔實際筆數
+    回 (N, 7)，欄位順序同 last_indicators；各檔獨立，以 prange 分散到多核"""
+    n = closes.shape[0]
+    out = np.empty((n, 7))
+    for i in prange(n):
+        r = last_indicators(closes[i, :lengths[i]])
+        for k in range(7):
+            out[i, k] = r[k]
     return out
 
 # ========= 建議（純量判斷版） =========
-def decide(row: pd.Series) -> Dict[str, Any]:
-    def S(key, default=np.nan):
-        try:
-            v = row.get(key, default)
-            return float(v) if v is not None and v != "" else default
-        except Exception:
-            return default
+DECISIONS = {  # 趨勢 -> (建議, 進場樣板, 出場樣板)；樣板以 m/l/u/s20 代入
+    "多頭": ("偏多→回到中軌/20MA 附近可分批；跌破下軌停損",
+             "靠近中軌≈{m:.2f}（±1%）", "跌破下軌≈{l:.2f} 或日收跌破20MA≈{s20:.2f}"),
+    "空頭": ("偏空→反彈至中軌附近逢高減碼；站回20MA觀望",
+             "反彈至中軌≈{m:.2f}", "突破上軌≈{u:.2f} 或站回20MA≈{s20:.2f}"),
+    "盤整": ("盤整→區間思維；下緣偏多、上緣偏賣",
+             "靠近下緣≈{l:.2f}", "靠近上緣≈{u:.2f}"),
+}
+
+def decide(df: pd.DataFrame) -> pd.DataFrame:
+    """整欄判斷多空/建議/信心（np.select 一次算完，不逐列呼叫）；回與 df 同 index 的五欄"""
+    def S(key):
+        # 非數值（空字串/None/缺欄）都視為 NaN
+        return pd.to_numeric(df[key], errors="coerce").to_numpy(dtype=np.float64) if key in df else np.full(len(df), np.nan)
 
     c = S("Close"); sma20 = S("SMA20"); sma50 = S("SMA50"); sma200 = S("SMA200")
     rsi = S("RSI14"); u = S("BB_Upper"); l = S("BB_Lower"); m = S("BB_Mid")
+    na = np.isnan(np.column_stack((c, sma20, sma50, sma200, rsi, u, l, m))).any(axis=1)
 
-    if any(map(lambda x: (x is np.nan) or (x != x), [c, sma20, sma50, sma200, rsi, u, l, m])):
-        return {"多空": "未知", "建議": "資料不足", "進場": "", "出場": "", "信心": 0}
-
-    # 結構
-    if sma20 > sma50 > sma200 and c > sma20:
-        trend = "多頭"
-    elif sma20 < sma50 < sma200 and c < sma20:
-        trend = "空頭"
-    else:
-        trend = "盤整"
-
-    # 建議（保守）
-    if trend == "多頭":
-        advice = "偏多→回到中軌/20MA 附近可分批；跌破下軌停損"
-        entry  = f"靠近中軌≈{m:.2f}（±1%）"
-        exit_  = f"跌破下軌≈{l:.2f} 或日收跌破20MA≈{sma20:.2f}"
-    elif trend == "空頭":
-        advice = "偏空→反彈至中軌附近逢高減碼；站回20MA觀望"
-        entry  = f"反彈至中軌≈{m:.2f}"
-        exit_  = f"突破上軌≈{u:.2f} 或站回20MA≈{sma20:.2f}"
-    else:
-        advice = "盤整→區間思維；下緣偏多、上緣偏賣"
-        entry  = f"靠近下緣≈{l:.2f}"
-        exit_  = f"靠近上緣≈{u:.2f}"
+    # 結構（NaN 比較一律 False，落到盤整，再由 na 蓋成未知）
+    bull = (sma20 > sma50) & (sma50 > sma200) & (c > sma20)
+    bear = (sma20 < sma50) & (sma50 < sma200) & (c < sma20)
+    trend = np.select([na, bull, bear], ["未知", "多頭", "空頭"], default="盤整")
 
     # 信心（簡易 0~100）
-    score = 50
-    score += 10 if trend == "多頭" else (-10 if trend == "空頭" else 0)
-    score += min(15, max(0, (abs(rsi - 50) / 50) * 15))
-    score = int(max(0, min(100, round(score))))
-
-    return {"多空": trend, "建議": advice, "進場": entry, "出場": exit_, "信心": score}
-
-# ========= 下載與彙整 =========
-def fetch(ticker: str) -> Tuple[pd.DataFrame, str, str]:
-    """回： (只取最後一列指標表, 公司名, 失敗訊息)"""
-    try:
-        hist = yf.download(ticker, period="400d", interval="1d", auto_adjust=True, progress=False)
-    except Exception as e:
-        return pd.DataFrame(), "", f"{ticker} 下載錯誤: {e}"
+    score = 50 + np.select([bull, bear], [10, -10], default=0) + np.clip(np.abs(rsi - 50) / 50 * 15, 0, 15)
+    score = np.where(na, 0, np.clip(np.round(score), 0, 100)).astype(np.int64)
 
-    if hist is None or hist.empty:
-        return pd.DataFrame(), "", f"{ticker} 無資料"
+    # 建議（保守）：文字含價位，只能逐檔格式化
+    texts = [("資料不足", "", "") if t == "未知" else
+             (DECISIONS[t][0],
+              DECISIONS[t][1].format(m=mi, l=lo, u=up, s20=s),
+              DECISIONS[t][2].format(m=mi, l=lo, u=up, s20=s))
+             for t, mi, lo, up, s in zip(trend.tolist(), m.tolist(), l.tolist(), u.tolist(), sma20.tolist())]
+    advice, entry, exit_ = zip(*texts) if texts else ((), (), ())
 
-    hist = hist.rename_axis("Date").reset_index()
-    hist = hist[["Date","Open","High","Low","Close","Volume"]]
-    hist = add_indicators(hist)
-    last = hist.iloc[-1].copy()
+    return pd.DataFrame({"多空趨勢": trend, "操作建議": advice, "建議進場": entry,
+                         "建議出場": exit_, "信心分數": score}, index=df.index)
 
-    # 名稱（取不到就空白）
-    name = ""
+# ========= 下載與彙整 =========
+def download_chunks(tickers: List[str], period: str) -> Tuple[Dict[str, pd.DataFrame], List[str]]:
+    """批次下載日K（每 BATCH_SIZE 檔一個請求）；回： ({ticker: 歷史資料}, 失敗訊息)"""
+    hists: Dict[str, pd.DataFrame] = {}; errs: List[str] = []
+    for i in range(0, len(tickers), BATCH_SIZE):
+        chunk = tickers[i:i + BATCH_SIZE]
+        try:
+            # 不另傳 session=：yfinance 內部整個行程共用一個 session（含 cookie/crumb），連線已重用
+            data = yf.download(chunk, period=period, interval="1d", auto_adjust=True,
+                               group_by="ticker", threads=True, progress=False)
+        except Exception as e:
+            errs += [f"{t} 下載錯誤: {e}" for t in chunk]
+            continue
+        got = set(data.columns.get_level_values(0)) if data is not None and not data.empty else set()
+        for t in chunk:
+            hist = data[t].dropna(subset=["Close"]) if t in got else None
+            if hist is None or hist.empty:
+                errs.append(f"{t} 無資料")
+                continue
+            hists[t] = hist
+        time.sleep(0.25)  # 禮貌節流（每批一次）
+    return hists, errs
+
+def download_batch(tickers: List[str]) -> Tuple[Dict[str, pd.DataFrame], List[str]]:
+    """取各檔日K：快取新鮮直接用；過期只補抓最近 DELTA_PERIOD 接尾巴；其餘整段下載
+    回： ({ticker: 歷史資料}, 失敗訊息)"""
+    hists: Dict[str, pd.DataFrame] = {}; stale: Dict[str, pd.DataFrame] = {}
+    for t in tickers:
+        hist, fresh = load_hist_cache(t)
+        if hist is None:
+            continue
+        if fresh:
+            hists[t] = hist
+        else:
+            stale[t] = hist
+
+    # 增量：接不上的（除權息、斷檔太久、補抓失敗）落到下面整段重抓，錯誤訊息以整段那次為準
+    if stale:
+        delta, _ = download_chunks(list(stale), DELTA_PERIOD)
+        for t, new in delta.items():
+            merged = merge_delta(stale[t], new)
+            if merged is not None:
+                hists[t] = merged
+                save_hist_cache(t, merged)
+
+    full, errs = download_chunks([t for t in tickers if t not in hists], f"{HIST_DAYS}d")
+    for t, hist in full.items():
+        hists[t] = hist
+        save_hist_cache(t, hist)
+    return hists, errs
+
+def lookup_name(ticker: str) -> str:
+    """公司名稱（取不到就空白）"""
     try:
         info = yf.Ticker(ticker).info
-        name = info.get("shortName") or ""
+        return info.get("shortName") or ""
     except Exception:
-        name = ""
+        return ""
+
+def last_bar(hist: pd.DataFrame) -> Dict[str, Any]:
+    """最後一根 K 的日期與 OHLCV 純量（iat 逐欄取，不用 iloc[-1] 另組一個 Series）"""
+    last = {c: hist[c].iat[-1] for c in ("Open", "High", "Low", "Close", "Volume") if c in hist.columns}
+    last["Date"] = hist.index[-1]
+    return last
 
-    dec = decide(last)
+def analyze(ticker: str, last: Dict[str, Any], ts: str, ind: np.ndarray, name: str = None) -> Tuple[Dict[str, Any], str]:
+    """回： (最後一列指標 row，不含 decide 的判斷欄, 公司名)；last 為 last_bar 結果；ts 為本批資料時戳；
+    ind 為 batch_indicators 的該檔結果；name 未給（快取沒有）才逐檔查詢"""
+    sma20, sma50, sma200, rsi, bb_mid, bb_up, bb_lo = ind
+
+    if name is None:
+        name = lookup_name(ticker)
 
     row = {
-        "資料時戳(Asia/Taipei)": now_str(),
+        "資料時戳(Asia/Taipei)": ts,
         "Date": last["Date"],
         "Ticker": ticker,
         "公司名稱": name,
         "Open": last["Open"], "High": last["High"], "Low": last["Low"], "Close": last["Close"],
         "Volume": last.get("Volume", ""),
-        "RSI14": last["RSI14"], "SMA20": last["SMA20"], "SMA50": last["SMA50"], "SMA200": last["SMA200"],
-        "BB_Mid": last["BB_Mid"], "BB_Upper": last["BB_Upper"], "BB_Lower": last["BB_Lower"],
-        "多空趨勢": dec["多空"], "操作建議": dec["建議"], "建議進場": dec["進場"], "建議出場": dec["出場"], "信心分數": dec["信心"]
+        "RSI14": rsi, "SMA20": sma20, "SMA50": sma50, "SMA200": sma200,
+        "BB_Mid": bb_mid, "BB_Upper": bb_up, "BB_Lower": bb_lo,
     }
-    return pd.DataFrame([row]), name, ""
+    return row, name
 
 def aggregate(tickers: List[str]) -> Tuple[pd.DataFrame, List[str]]:
-    rows = []; errs = []
-    for t in tickers:
-        df1, _, err = fetch(t)
-        if not df1.empty:
-            rows.append(df1)
-        if err:
-            errs.append(err)
-        time.sleep(0.25)  # 禮貌節流
-    if rows:
-        out = pd.concat(rows, ignore_index=True)
-        # 排序：Ticker
-        out = out.sort_values(["Ticker"]).reset_index(drop=True)
-    else:
-        out = pd.DataFrame(columns=[
-            "資料時戳(Asia/Taipei)","Date","Ticker","公司名稱","Open","High","Low","Close","Volume",
-            "RSI14","SMA20","SMA50","SMA200","BB_Mid","BB_Upper","BB_Lower",
-            "多空趨勢","操作建議","建議進場","建議出場","信心分數"
-        ])
+    hists, errs = download_batch(tickers)
+    ts = now_str()  # 整批共用一個時戳，不逐檔取時間
+    todo = [t for t in tickers if t in hists]
+
+    # 指標：收盤價疊成 (N, T) 一次算完；取完收盤價與最後一根就放掉整張日K
+    lengths = np.array([len(hists[t]) for t in todo], dtype=np.int64)
+    closes = np.full((len(todo), lengths.max(initial=0)), np.nan)
+    lasts = {}
+    for i, t in enumerate(todo):
+        closes[i, :lengths[i]] = hists[t]["Close"].to_numpy(dtype=np.float64)
+        lasts[t] = last_bar(hists.pop(t))
+    del hists
+    ind = batch_indicators(closes, lengths)
+
+    # 各檔互相獨立：名稱查詢是網路 I/O，用執行緒並行
+    names = load_name_cache()
+    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as ex:
+        results = list(ex.map(lambda t, r: analyze(t, lasts[t], ts, r, names.get(t)), todo, ind))
+    rows = [row for row, _ in results]
+    fresh = {t: name for t, (_, name) in zip(todo, results) if name and t not in names}
+    if fresh:
+        save_name_cache(fresh)
+    # 先轉成逐欄 list（SoA）再一次建表：不逐檔建單列 DataFrame 再 concat，也不讓 pandas 逐列對鍵
+    out = pd.DataFrame({c: [r[c] for r in rows] for c in (rows[0] if rows else ())})
+    # 判斷欄整欄一次算，再依 COLUMNS 排欄
+    out = pd.concat([out, decide(out)], axis=1).reindex(columns=list(COLUMNS))
+    # 排序：Ticker
+    out = out.sort_values(["Ticker"]).reset_index(drop=True)
     return out, errs
 
 def top10_by_volume(df_nonfin: pd.DataFrame) -> pd.DataFrame:
     if df_nonfin.empty: return df_nonfin
-    return df_nonfin.sort_values("Volume", ascending=False).head(10).reset_index(drop=True)
+    # 不用 nlargest：它會丟掉 Volume 為 NaN 的列、同值時順序也可能不同；stable 排序讓同量依原順序
+    return df_nonfin.sort_values("Volume", ascending=False, kind="stable").head(10).reset_index(drop=True)
 
 def hot20_score(df_nonfin: pd.DataFrame) -> pd.DataFrame:
     if df_nonfin.empty: return df_nonfin
@@ -281,7 +529,7 @@ def hot20_score(df_nonfin: pd.DataFrame) -> pd.DataFrame:
     d["z_dist"] = z(d["距離中軌%"])
     d["z_vola"] = z(d["波動%"])
     d["熱度分數"] = d[["z_vol","z_dist","z_vola"]].sum(axis=1)
-    d = d.sort_values(["熱度分數","Volume"], ascending=[False, False]).reset_index(drop=True)
+    d = d.sort_values(["熱度分數","Volume"], ascending=[False, False], kind="stable").reset_index(drop=True)
     return d.head(20)
 
 # ========= 主流程 =========
@@ -291,26 +539,31 @@ def main():
     sh = open_sheet()
     all_list, fin_list, nonfin_list = load_config()
 
-    # 全表（取最後一列）
-    fin_df, fin_errs     = aggregate(fin_list)
-    nonfin_df, nonf_errs = aggregate(nonfin_list)
+    # 全表（取最後一列）：金融/非金融合併成一趟下載與分析，再依清單拆表
+    all_df, errs = aggregate(list(dict.fromkeys(fin_list + nonfin_list)))
+    is_fin    = all_df["Ticker"].isin(set(fin_list))
+    fin_df    = all_df[is_fin].reset_index(drop=True)
+    nonfin_df = all_df[~is_fin].reset_index(drop=True)
 
     # 衍生表
     top10 = top10_by_volume(nonfin_df)
     hot20 = hot20_score(nonfin_df)
     top5  = hot20.head(5).reset_index(drop=True) if not hot20.empty else hot20
 
-    # 寫入
-    write_df(sh, TAB_FIN,    fin_df)
-    write_df(sh, TAB_NONFIN, nonfin_df)
-    write_df(sh, TAB_TOP10,  top10)
-    write_df(sh, TAB_HOT20,  hot20)
-    write_df(sh, TAB_TOP5H20, top5)
-
     # Logs
-    logs = fin_errs + nonf_errs
-    logs_df = pd.DataFrame({"Time(Asia/Taipei)": [now_str()]*len(logs), "Message": logs}) if logs else pd.DataFrame({"Time(Asia/Taipei)": [now_str()], "Message": ["本次全部成功"]})
-    write_df(sh, TAB_LOGS, logs_df, stamp=False)
+    logs = errs
+    ts = now_str()
+    logs_df = pd.DataFrame({"Time(Asia/Taipei)": [ts]*len(logs), "Message": logs}) if logs else pd.DataFrame({"Time(Asia/Taipei)": [ts], "Message": ["本次全部成功"]})
+
+    # 寫入（全部分頁一次批次）
+    write_tabs(sh, [
+        (TAB_FIN,     fin_df,    True),
+        (TAB_NONFIN,  nonfin_df, True),
+        (TAB_TOP10,   top10,     True),
+        (TAB_HOT20,   hot20,     True),
+        (TAB_TOP5H20, top5,      True),
+        (TAB_LOGS,    logs_df,   False),
+    ])
 
     print("[OK] 完成 ✅")
 